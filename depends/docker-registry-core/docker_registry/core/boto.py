@@ -29,8 +29,17 @@ Might be useful for
 import gevent.monkey
 gevent.monkey.patch_all()
 
+import collections
+import contextlib
+import functools
+import httplib
 import logging
 import os
+import socket
+import time
+
+import gevent
+import gevent.lock
 
 from . import driver
 from . import lru
@@ -38,6 +47,123 @@ from .exceptions import FileNotFoundError
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10
+
+
+class BucketPool(object):
+    """pool of boto connections, with their bucket handle
+
+    Greenlets check a bucket out for the duration of a storage call, so that
+    concurrent calls run on connections of their own instead of colliding on
+    a single one. At most `size' connections are open, the idle ones are kept
+    (alive) for the next calls. A connection is dropped, instead of going
+    back to the pool, when its call was interrupted or failed with a socket
+    or HTTP error.
+
+    Nested checkouts from the same greenlet reuse its bucket, which goes back
+    to the pool once all of them are over, in whatever order they end.
+
+    Streams (see stream_bucket) wait on their client between reads, for as
+    long as it takes: they run on connections outside of the `size' cap, so
+    that slow transfers never hold back the other calls.
+    """
+
+    def __init__(self, factory, size, idle=None):
+        self._factory = factory
+        self.size = size
+        self._idle = list(idle or [])
+        self._semaphore = gevent.lock.BoundedSemaphore(size)
+        # [bucket, depth, broken] by greenlet
+        self._checked_out = {}
+        self.stats = {'checkouts': 0, 'waits': 0, 'wait_seconds': 0.0,
+                      'created': len(self._idle), 'recycled': 0,
+                      'streams': 0}
+
+    def current(self):
+        """Return the bucket checked out by the current greenlet, if any."""
+        entry = self._checked_out.get(gevent.getcurrent())
+        if entry is not None:
+            return entry[0]
+
+    def _checkout(self):
+        if not self._semaphore.acquire(blocking=False):
+            start = time.time()
+            self.stats['waits'] += 1
+            self._semaphore.acquire()
+            self.stats['wait_seconds'] += time.time() - start
+        self.stats['checkouts'] += 1
+        try:
+            if self._idle:
+                return self._idle.pop()
+            bucket = self._factory()
+            self.stats['created'] += 1
+            return bucket
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    @contextlib.contextmanager
+    def bucket(self):
+        greenlet = gevent.getcurrent()
+        entry = self._checked_out.get(greenlet)
+        if entry is None:
+            entry = [self._checkout(), 0, False]
+            self._checked_out[greenlet] = entry
+        entry[1] += 1
+        try:
+            yield entry[0]
+        except BaseException as e:
+            if not entry[2] and self._broken(e):
+                logger.debug('Dropping boto connection: {0!r}'.format(e))
+                entry[2] = True
+            raise
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._checked_out[greenlet]
+                if entry[2]:
+                    self.stats['recycled'] += 1
+                else:
+                    self._idle.append(entry[0])
+                self._semaphore.release()
+
+    @contextlib.contextmanager
+    def stream_bucket(self):
+        """Check a bucket out for a stream, regardless of the calls in
+        progress. It goes back to the pool afterwards if there is room."""
+        if self._idle:
+            bucket = self._idle.pop()
+        else:
+            bucket = self._factory()
+            self.stats['created'] += 1
+        self.stats['streams'] += 1
+        try:
+            yield bucket
+        except BaseException as e:
+            if self._broken(e):
+                logger.debug('Dropping boto connection: {0!r}'.format(e))
+                self.stats['recycled'] += 1
+                bucket = None
+            raise
+        finally:
+            if bucket is not None and len(self._idle) < self.size:
+                self._idle.append(bucket)
+
+    def _broken(self, e):
+        # Interrupted (GeneratorExit, gevent.Timeout...) or failed I/O: the
+        # connection may hold a partially read response
+        return (not isinstance(e, Exception) or
+                isinstance(e, (socket.error, httplib.HTTPException)))
+
+
+def pooled(f):
+    """Run a storage call with a bucket checked out of the pool."""
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self._pool.bucket():
+            return f(self, *args, **kwargs)
+    return wrapper
+
 
 class Base(driver.Base):
 
@@ -47,10 +173,31 @@ class Base(driver.Base):
         self._config = config
         self._root_path = path or '/test'
         self._boto_conn = self.makeConnection()
-        self._boto_bucket = self._boto_conn.get_bucket(
+        self._default_bucket = self._boto_conn.get_bucket(
             self._config.boto_bucket)
+        self._pool = BucketPool(
+            self._make_bucket,
+            int(self._config.boto_pool_size or DEFAULT_POOL_SIZE),
+            idle=[self._default_bucket])
         logger.info("Boto based storage initialized")
 
+    def _make_bucket(self):
+        # Bucket existence was checked on startup
+        return self.makeConnection().get_bucket(
+            self._config.boto_bucket, validate=False)
+
+    @property
+    def _boto_bucket(self):
+        """The bucket checked out by the current greenlet (see pooled)."""
+        return self._pool.current() or self._default_bucket
+
+    def pool_stats(self):
+        """Return the connection pool usage, waits included."""
+        stats = dict(self._pool.stats)
+        stats['size'] = self._pool.size
+        stats['idle'] = len(self._pool._idle)
+        return stats
+
     def _build_connection_params(self):
         kwargs = {'is_secure': (self._config.s3_secure is True)}
         config_args = [
@@ -84,18 +231,66 @@ class Base(driver.Base):
         return path
 
     def stream_read(self, path, bytes_range=None):
+        read_ahead = int(self._config.boto_read_ahead or 0)
+        if read_ahead > 0:
+            for buf in self._stream_read_ahead(path, bytes_range, read_ahead):
+                yield buf
+            return
         path = self._init_path(path)
         headers = None
         if bytes_range:
             headers = {'Range': 'bytes={0}-{1}'.format(*bytes_range)}
-        key = self._boto_bucket.lookup(path, headers=headers)
+        with self._pool.stream_bucket() as bucket:
+            key = bucket.lookup(path, headers=headers)
+            if not key:
+                raise FileNotFoundError('%s is not there' % path)
+            while True:
+                buf = key.read(self.buffer_size)
+                if not buf:
+                    break
+                yield buf
+
+    @pooled
+    def _fetch_range(self, path, start, end):
+        key = self._boto_bucket.new_key(path)
+        return key.get_contents_as_string(
+            headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+
+    def _stream_read_ahead(self, path, bytes_range, read_ahead):
+        """Stream a key with ranged GETs running ahead of the consumer
+
+        While one chunk is being sent, the next `read_ahead' ranges are
+        already being fetched by their own greenlets. Chunks are yielded in
+        order and at most `read_ahead' + 1 of them are held in memory.
+        """
+        path = self._init_path(path)
+        with self._pool.bucket() as bucket:
+            key = bucket.lookup(path)
         if not key:
             raise FileNotFoundError('%s is not there' % path)
-        while True:
-            buf = key.read(self.buffer_size)
-            if not buf:
-                break
-            yield buf
+        # Ranges are fetched on connections of their own
+        chunk_size = int(self._config.boto_read_ahead_chunk or
+                         4 * 1024 * 1024)
+        start, end = 0, key.size - 1
+        if bytes_range:
+            start = bytes_range[0]
+            end = min(bytes_range[1], end)
+        pending = collections.deque()
+        try:
+            offset = start
+            while offset <= end or pending:
+                if offset <= end:
+                    last = min(offset + chunk_size, end + 1) - 1
+                    pending.append(gevent.spawn(
+                        self._fetch_range, path, offset, last))
+                    offset = last + 1
+                    if offset <= end and len(pending) <= read_ahead:
+                        continue
+                buf = pending.popleft().get()
+                for i in range(0, len(buf), self.buffer_size):
+                    yield buf[i:i + self.buffer_size]
+        finally:
+            gevent.killall(pending)
 
     def list_directory(self, path=None):
         path = self._init_path(path)
@@ -105,18 +300,26 @@ class Base(driver.Base):
         if self._root_path != '/':
             ln = len(self._root_path)
         exists = False
-        for key in self._boto_bucket.list(prefix=path, delimiter='/'):
-            if '%s/' % key.name == path:
-                continue
-            exists = True
-            name = key.name
-            if name.endswith('/'):
-                yield name[ln:-1]
-            else:
-                yield name[ln:]
+        with self._pool.stream_bucket() as bucket:
+            try:
+                for key in bucket.list(prefix=path, delimiter='/'):
+                    if '%s/' % key.name == path:
+                        continue
+                    exists = True
+                    name = key.name
+                    if name.endswith('/'):
+                        yield name[ln:-1]
+                    else:
+                        yield name[ln:]
+            except GeneratorExit:
+                # Listing pages are read whole before their keys are
+                # yielded: the connection is not left mid-response
+                return
         if not exists:
             raise FileNotFoundError('%s is not there' % path)
 
+    @lru.get_size
+    @pooled
     def get_size(self, path):
         path = self._init_path(path)
         # Lookup does a HEAD HTTP Request on the object
@@ -126,6 +329,7 @@ class Base(driver.Base):
         return key.size
 
     @lru.get
+    @pooled
     def get_content(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
@@ -133,13 +337,17 @@ class Base(driver.Base):
             raise FileNotFoundError('%s is not there' % path)
         return key.get_contents_as_string()
 
+    @lru.exists
+    @pooled
     def exists(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
         return key.exists()
 
     @lru.remove
+    @pooled
     def remove(self, path):
+        dirname = path.rstrip('/')
         path = self._init_path(path)
         key = self.makeKey(path)
         if key.exists():
@@ -155,5 +363,6 @@ class Base(driver.Base):
                 continue
             exists = True
             key.delete()
+            lru.forget('{0}/{1}'.format(dirname, key.name[len(path):]))
         if not exists:
             raise FileNotFoundError('%s is not there' % path)
@@ -82,6 +82,7 @@ class Base(object):
     # the code which uses Storage
     repositories = 'repositories'
     images = 'images'
+    blobs = 'blobs'
 
     def _repository_path(self, namespace, repository):
         return '{0}/{1}/{2}'.format(
@@ -91,6 +92,11 @@ class Base(object):
     buffer_size = 128 * 1024
     # By default no storage plugin supports it
     supports_bytes_range = False
+    # Drivers able to assemble an object from parts uploaded separately (see
+    # initiate_upload) set this, and the minimum size of all parts but the
+    # last one
+    supports_multipart_upload = False
+    multipart_min_size = 0
 
     def __init__(self, path=None, config=None):
         pass
@@ -122,6 +128,14 @@ class Base(object):
     def image_ancestry_path(self, image_id):
         return '{0}/{1}/ancestry'.format(self.images, image_id)
 
+    @filter_args
+    def image_parent_path(self, image_id):
+        return '{0}/{1}/_parent'.format(self.images, image_id)
+
+    @filter_args
+    def image_metadata_path(self, image_id):
+        return '{0}/{1}/_metadata'.format(self.images, image_id)
+
     @filter_args
     def image_files_path(self, image_id):
         return '{0}/{1}/_files'.format(self.images, image_id)
@@ -130,6 +144,30 @@ class Base(object):
     def image_diff_path(self, image_id):
         return '{0}/{1}/_diff'.format(self.images, image_id)
 
+    @filter_args
+    def image_blob_path(self, image_id):
+        return '{0}/{1}/_blob'.format(self.images, image_id)
+
+    @filter_args
+    def image_digest_path(self, image_id):
+        return '{0}/{1}/_digest'.format(self.images, image_id)
+
+    @filter_args
+    def blob_path(self, algorithm, digest):
+        return '{0}/{1}/{2}'.format(self.blobs, algorithm, digest)
+
+    @filter_args
+    def image_upload_path(self, image_id):
+        return '{0}/{1}/_upload'.format(self.images, image_id)
+
+    @filter_args
+    def image_parts_path(self, image_id):
+        return '{0}/{1}/_parts'.format(self.images, image_id)
+
+    @filter_args
+    def image_merged_path(self, image_id):
+        return '{0}/{1}/_merged'.format(self.images, image_id)
+
     @filter_args
     def repository_path(self, namespace, repository):
         return '{0}/{1}/{2}'.format(
@@ -181,6 +219,15 @@ class Base(object):
         """
         return None
 
+    def local_path(self, path):
+        """Get a local filesystem path for content at path
+
+        Return the path of a file holding the content, so that it can be
+        handed over to the kernel (sendfile) instead of being streamed through
+        python. Return None if not supported by this engine.
+        """
+        return None
+
     def get_json(self, path):
         return json.loads(self.get_unicode(path))
 
@@ -225,6 +272,34 @@ class Base(object):
             "on your storage %s" %
             self.__class__.__name__)
 
+    def initiate_upload(self, path):
+        """Start a multipart upload to path, return its id."""
+        raise NotImplementedError(
+            "You must implement initiate_upload(self, path) " +
+            "on your storage %s" %
+            self.__class__.__name__)
+
+    def upload_part(self, path, upload_id, num_part, fp):
+        """Upload the part `num_part' (from 1) of a multipart upload."""
+        raise NotImplementedError(
+            "You must implement upload_part(self, path, upload_id, " +
+            "num_part, fp) on your storage %s" %
+            self.__class__.__name__)
+
+    def complete_upload(self, path, upload_id):
+        """Assemble the parts of a multipart upload into path."""
+        raise NotImplementedError(
+            "You must implement complete_upload(self, path, upload_id) " +
+            "on your storage %s" %
+            self.__class__.__name__)
+
+    def cancel_upload(self, path, upload_id):
+        """Abort a multipart upload, dropping its parts."""
+        raise NotImplementedError(
+            "You must implement cancel_upload(self, path, upload_id) " +
+            "on your storage %s" %
+            self.__class__.__name__)
+
     def list_directory(self, path=None):
         """Method to list directory."""
         raise NotImplementedError(
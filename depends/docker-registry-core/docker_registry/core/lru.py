@@ -22,21 +22,128 @@ Redis based LRU.
 Can be activated or de-activated globally.
 Drivers are largely encouraged to use it.
 By default, doesn't run, until one calls init().
+
+Besides content (get/set/remove), the existence and size of paths can be
+cached (exists/get_size): paths known not to exist are only cached for
+`negative_ttl' seconds (see init), as they may be created by another registry
+sharing the storage. Existing ones are cached for the TTL of their class of
+path, or STAT_TTL seconds if it has none, as they may be removed behind the
+registry's back. Writes and removes through the driver invalidate them,
+bumping the version of the path: a stat computed meanwhile is not stored.
+
+Content can also be kept in-process (see LocalCache), in front of Redis, up to
+`local_size' bytes. Writes and removes are then published on a Redis channel,
+so that every worker drops its copy. Nothing is kept in-process until the
+subscription is confirmed, and everything is dropped whenever it is lost. As a
+message may still be missed, local entries also expire: after `local_ttl'
+seconds, or `local_immutable_ttl' for the keys never rewritten once an image
+is pushed (IMMUTABLE_KEYS, once the image mark is gone).
+
+Content larger than `max_object_size' (once compressed) is not cached, so that
+large file lists don't evict the small hot objects. Content above
+`compress_threshold' is stored compressed with zlib. Entries expire after the
+TTL of their class of path (see path_class), none by default for the immutable
+image metadata. Hits, misses, rejections and evictions from the in-process
+cache are counted by class in `stats'.
 """
 
 import functools
 import logging
+import os
+import re
+import threading
+import time
+import zlib
 
 import redis
+
+from .exceptions import FileNotFoundError
+
 logger = logging.getLogger(__name__)
 
 redis_conn = None
 cache_prefix = None
+stat_prefix = None
+version_prefix = None
+
+NEGATIVE_TTL = 10
+stat_negative_ttl = NEGATIVE_TTL
+
+# Redis TTL of the stat entries of existing paths whose class has none
+STAT_TTL = 3600
+# Redis TTL of the stat versions, longer than any storage call
+VERSION_TTL = 3600
+# stat entries: the size of a path, or one of
+MISSING = b'-'
+EXISTS = b'+'
+
+LOCAL_TTL = 10
+LOCAL_IMMUTABLE_TTL = 3600
+# json, ancestry and parent of an image, once pushed
+IMMUTABLE_KEYS = re.compile(r'(^|/)images/[^/]+/(json|ancestry|_parent)$')
+TAG_KEYS = re.compile(r'(^|/)repositories/[^/]+/[^/]+/tag[^/]*$')
+
+PATH_CLASSES = ('image', 'tag', 'other')
+# Redis TTL by class of path, 0 for none
+TTLS = {'image': 0, 'tag': 600, 'other': 86400}
+ttls = dict(TTLS)
+stats = dict((name, {'hits': 0, 'local_hits': 0, 'misses': 0,
+                     'rejected': 0, 'evictions': 0})
+             for name in PATH_CLASSES)
+
+MAX_OBJECT_SIZE = 512 * 1024
+COMPRESS_THRESHOLD = 16 * 1024
+max_object_size = MAX_OBJECT_SIZE
+compress_threshold = COMPRESS_THRESHOLD
+# Marks compressed content, can't start a JSON document
+COMPRESSED = b'\x00lru:zlib\x00'
+
+local_cache = None
+invalidation_channel = None
+
+# Store ARGV[1] in KEYS[1] unless already there, with a TTL of ARGV[2]
+# seconds (if any), return whether it was
+_set_script = None
+SET_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and current ~= '' and current == ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 1
+"""
+# Store the stat ARGV[2] in KEYS[1] for ARGV[3] seconds, unless the version
+# of the path (KEYS[2]) changed since it was ARGV[1]
+_stat_script = None
+STAT_SCRIPT = """
+local version = redis.call('GET', KEYS[2]) or ''
+if version ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+# bumped on every invalidation, see get
+_generation = 0
+_listener_pid = None
+# whether the listener of the current process is subscribed to invalidations
+_subscribed = False
 
 
 def init(enable=True,
-         host='localhost', port=6379, db=0, password=None, path='/'):
-    global redis_conn, cache_prefix
+         host='localhost', port=6379, db=0, password=None, path='/',
+         negative_ttl=NEGATIVE_TTL, local_size=0, local_ttl=LOCAL_TTL,
+         local_immutable_ttl=LOCAL_IMMUTABLE_TTL,
+         max_size=MAX_OBJECT_SIZE, compress_size=COMPRESS_THRESHOLD,
+         class_ttls=None):
+    global redis_conn, cache_prefix, stat_prefix, stat_negative_ttl
+    global version_prefix, local_cache, invalidation_channel, _set_script
+    global _stat_script
+    global max_object_size, compress_threshold
     if not enable:
         redis_conn = None
         return
@@ -52,30 +159,239 @@ def init(enable=True,
                                    port=int(port),
                                    db=int(db),
                                    password=password)
+    _set_script = redis_conn.register_script(SET_SCRIPT)
+    _stat_script = redis_conn.register_script(STAT_SCRIPT)
     cache_prefix = 'cache_path:{0}'.format(path)
+    stat_prefix = 'cache_stat:{0}'.format(path)
+    version_prefix = 'cache_version:{0}'.format(path)
+    stat_negative_ttl = int(negative_ttl)
+    max_object_size = int(max_size)
+    compress_threshold = int(compress_size)
+    ttls.clear()
+    ttls.update(TTLS)
+    ttls.update((name, int(ttl)) for name, ttl in (class_ttls or {}).items())
+    invalidation_channel = 'cache_invalidate:{0}'.format(path)
+    local_cache = None
+    if local_size:
+        local_cache = LocalCache(int(local_size), int(local_ttl),
+                                 int(local_immutable_ttl))
 
 
 def cache_key(key):
     return cache_prefix + key
 
 
+def path_class(key):
+    if IMMUTABLE_KEYS.search(key):
+        return 'image'
+    if TAG_KEYS.search(key):
+        return 'tag'
+    return 'other'
+
+
+def _count(key, event):
+    stats[path_class(key)][event] += 1
+
+
+def _encode(key, content):
+    """Return what is stored in Redis for content, None if not admitted."""
+    if not isinstance(content, bytes):
+        content = content.encode('utf8')
+    if compress_threshold and len(content) >= compress_threshold:
+        content = COMPRESSED + zlib.compress(content)
+    if max_object_size and len(content) > max_object_size:
+        _count(key, 'rejected')
+        return None
+    return content
+
+
+def _decode(value):
+    if value is not None and value.startswith(COMPRESSED):
+        return zlib.decompress(value[len(COMPRESSED):])
+    return value
+
+
+# fields of the LocalCache links
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+
+class LocalCache(object):
+    """in-process LRU, bounded by the size of its values
+
+    Entries live for `ttl' seconds, `immutable_ttl' for those set as
+    immutable. They are kept in a circular doubly linked list, most recently
+    used first.
+    """
+
+    def __init__(self, max_size, ttl=LOCAL_TTL,
+                 immutable_ttl=LOCAL_IMMUTABLE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.immutable_ttl = immutable_ttl
+        self.size = 0
+        self._links = {}
+        self._root = [None, None, None, None, 0]
+        self._root[PREV] = self._root[NEXT] = self._root
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _link_first(self, link):
+        first = self._root[NEXT]
+        link[PREV] = self._root
+        link[NEXT] = first
+        first[PREV] = link
+        self._root[NEXT] = link
+
+    def get(self, key):
+        link = self._links.get(key)
+        if link is None:
+            return None
+        if link[EXPIRES] < time.time():
+            self.pop(key)
+            return None
+        self._unlink(link)
+        self._link_first(link)
+        return link[VALUE]
+
+    def set(self, key, value, immutable=False):
+        self.pop(key)
+        if len(value) > self.max_size:
+            return
+        ttl = self.ttl
+        if immutable:
+            ttl = self.immutable_ttl
+        link = [None, None, key, value, time.time() + ttl]
+        self._link_first(link)
+        self._links[key] = link
+        self.size += len(value)
+        while self.size > self.max_size:
+            # Least recently used
+            _count(self._root[PREV][KEY], 'evictions')
+            self.pop(self._root[PREV][KEY])
+
+    def pop(self, key):
+        link = self._links.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.size -= len(link[VALUE])
+
+    def clear(self):
+        self._links.clear()
+        self._root[PREV] = self._root[NEXT] = self._root
+        self.size = 0
+
+
+def _drop_local(key=None):
+    """Drop a key (or everything) from the in-process cache."""
+    global _generation
+    _generation += 1
+    if local_cache is None:
+        # disabled since the listener started
+        return
+    if key is None:
+        local_cache.clear()
+    else:
+        local_cache.pop(key)
+
+
+def _listen():
+    global _subscribed
+    while True:
+        try:
+            pubsub = redis_conn.pubsub()
+            pubsub.subscribe(invalidation_channel)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    # Invalidations may have been missed until now
+                    _drop_local()
+                    _subscribed = True
+                elif message['type'] == 'message':
+                    _drop_local(message['data'].decode('utf8'))
+        except redis.exceptions.ConnectionError as e:
+            logging.warning("LRU: Redis connection error: {0}".format(e))
+        _subscribed = False
+        _drop_local()
+        time.sleep(1)
+
+
+def _get_local():
+    """Return the in-process cache, or None until the current process (which
+    may have been forked since init) is subscribed to invalidations."""
+    global _listener_pid, _subscribed
+    if local_cache is None:
+        return None
+    if _listener_pid != os.getpid():
+        _listener_pid = os.getpid()
+        _subscribed = False
+        local_cache.clear()
+        # a greenlet once gevent has patched threading
+        listener = threading.Thread(target=_listen)
+        listener.daemon = True
+        listener.start()
+    if not _subscribed:
+        return None
+    return local_cache
+
+
+def _immutable(driver, key):
+    """Whether a key is never rewritten anymore: the metadata of an image,
+    once the image is pushed."""
+    if not IMMUTABLE_KEYS.search(key):
+        return False
+    return not driver.exists('{0}/_inprogress'.format(key.rsplit('/', 1)[0]))
+
+
+def _invalidate(key):
+    """Drop a key from the in-process cache of every worker."""
+    _get_local()
+    if local_cache is None:
+        return
+    _drop_local(key)
+    try:
+        redis_conn.publish(invalidation_channel, key)
+    except redis.exceptions.ConnectionError as e:
+        logging.warning("LRU: Redis connection error: {0}".format(e))
+
+
+def stat_key(key):
+    return stat_prefix + key
+
+
+def version_key(key):
+    return version_prefix + key
+
+
 def set(f):
     @functools.wraps(f)
     def wrapper(*args):
         content = args[-1]
         key = args[-2]
         key = cache_key(key)
+        value = _encode(args[-2], content)
         try:
-            cached_content = get_by_key(key)
-            if cached_content and cached_content == content:
+            if value is None:
+                # Not admitted, drop what was cached
+                redis_conn.delete(key)
+            # Compared and set on the server, in a single round trip
+            elif not _set_script(keys=[key],
+                                 args=[value, ttls[path_class(args[-2])]]):
                 # If cached content is the same as what we are about to
                 # write, we don't need to write again.
                 return args[-2]
-            redis_conn.set(key, content)
         except redis.exceptions.ConnectionError as e:
             logging.warning("LRU: Redis connection error: {0}".format(e))
+        _invalidate(args[-2])
 
-        return f(*args)
+        try:
+            return f(*args)
+        except BaseException:
+            # Don't serve what could not be written
+            forget(args[-2])
+            raise
+        finally:
+            forget_stat(args[-2])
     if redis_conn is None:
         return f
     return wrapper
@@ -84,25 +400,51 @@ def set(f):
 def get(f):
     @functools.wraps(f)
     def wrapper(*args):
+        local = _get_local()
+        if local is not None:
+            content = local.get(args[-1])
+            if content is not None:
+                _count(args[-1], 'local_hits')
+                return content
+            # Unless invalidated meanwhile, what is read next is current
+            generation = _generation
         key = args[-1]
         key = cache_key(key)
-        content = get_by_key(key)
+        content = _decode(get_by_key(key))
 
+        admitted = True
         if content is not None:
-            return content
-        # Refresh cache
-        content = f(*args)
-        if content is not None:
-            try:
-                redis_conn.set(key, content)
-            except redis.exceptions.ConnectionError as e:
-                logging.warning("LRU: Redis connection error: {0}".format(e))
+            _count(args[-1], 'hits')
+        else:
+            _count(args[-1], 'misses')
+            # Refresh cache
+            content = f(*args)
+            if content is not None:
+                value = _encode(args[-1], content)
+                admitted = value is not None
+                if admitted:
+                    _store(key, value, ttls[path_class(args[-1])])
+        if content is not None and admitted and local is not None:
+            # may yield: compared to the generation after it
+            immutable = _immutable(args[0], args[-1])
+            if generation == _generation:
+                local.set(args[-1], content, immutable)
         return content
     if redis_conn is None:
         return f
     return wrapper
 
 
+def _store(key, value, ttl):
+    try:
+        if ttl:
+            redis_conn.setex(key, ttl, value)
+        else:
+            redis_conn.set(key, value)
+    except redis.exceptions.ConnectionError as e:
+        logging.warning("LRU: Redis connection error: {0}".format(e))
+
+
 def get_by_key(key):
     try:
         content = redis_conn.get(key)
@@ -121,7 +463,107 @@ def remove(f):
             redis_conn.delete(key)
         except redis.exceptions.ConnectionError as e:
             logging.warning("LRU: Redis connection error: {0}".format(e))
-        return f(*args)
+        _invalidate(args[-1])
+        try:
+            return f(*args)
+        finally:
+            forget_stat(args[-1])
+    if redis_conn is None:
+        return f
+    return wrapper
+
+
+def forget(key):
+    """Drop everything cached about a path (removed with its directory)."""
+    if redis_conn is None:
+        return
+    try:
+        redis_conn.delete(cache_key(key))
+    except redis.exceptions.ConnectionError as e:
+        logging.warning("LRU: Redis connection error: {0}".format(e))
+    forget_stat(key)
+    _invalidate(key)
+
+
+def forget_stat(key):
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.incr(version_key(key))
+        pipe.expire(version_key(key), VERSION_TTL)
+        pipe.delete(stat_key(key))
+        pipe.execute()
+    except redis.exceptions.ConnectionError as e:
+        logging.warning("LRU: Redis connection error: {0}".format(e))
+
+
+def _get_stat(key):
+    """Return the stat entry of a path and its version, which _set_stat
+    needs."""
+    try:
+        return redis_conn.mget(stat_key(key), version_key(key))
+    except redis.exceptions.ConnectionError as e:
+        logging.warning("LRU: Redis connection error: {0}".format(e))
+        return None, None
+
+
+def _set_stat(key, value, version):
+    if value == MISSING:
+        ttl = stat_negative_ttl
+    else:
+        ttl = ttls[path_class(key)] or STAT_TTL
+    try:
+        _stat_script(keys=[stat_key(key), version_key(key)],
+                     args=[version or '', value, ttl])
+    except redis.exceptions.ConnectionError as e:
+        logging.warning("LRU: Redis connection error: {0}".format(e))
+
+
+def invalidate(f):
+    """For methods writing to a path (given before the content), other
+    than set."""
+    @functools.wraps(f)
+    def wrapper(*args):
+        try:
+            return f(*args)
+        finally:
+            # After the write: a concurrent read would cache it as missing
+            forget_stat(args[-2])
+    if redis_conn is None:
+        return f
+    return wrapper
+
+
+def exists(f):
+    @functools.wraps(f)
+    def wrapper(*args):
+        key = args[-1]
+        stat, version = _get_stat(key)
+        if stat is not None:
+            return stat != MISSING
+        result = f(*args)
+        _set_stat(key, EXISTS if result else MISSING, version)
+        return result
+    if redis_conn is None:
+        return f
+    return wrapper
+
+
+def get_size(f):
+    @functools.wraps(f)
+    def wrapper(*args):
+        key = args[-1]
+        stat, version = _get_stat(key)
+        if stat == MISSING:
+            raise FileNotFoundError('%s is not there' % key)
+        if stat is not None and stat != EXISTS:
+            return int(stat)
+        try:
+            size = f(*args)
+        except FileNotFoundError:
+            _set_stat(key, MISSING, version)
+            raise
+        _set_stat(key, str(size), version)
+        return size
     if redis_conn is None:
         return f
     return wrapper
@@ -63,6 +63,9 @@ class Storage(driver.Base):
             f.write(content)
         return path
 
+    def local_path(self, path):
+        return self._init_path(path)
+
     def stream_read(self, path, bytes_range=None):
         path = self._init_path(path)
         nb_bytes = 0
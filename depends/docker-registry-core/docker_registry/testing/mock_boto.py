@@ -23,6 +23,7 @@ from . import utils
 import boto.s3.bucket
 import boto.s3.connection
 import boto.s3.key
+import boto.s3.prefix
 import six
 
 Bucket__init__ = boto.s3.bucket.Bucket.__init__
@@ -69,17 +70,32 @@ class Bucket(boto.s3.bucket.Bucket):
 
     def __init__(self, *args, **kwargs):
         Bucket__init__(self, *args, **kwargs)
-        Bucket._bucket[self.name] = mock_dict.MockDict()
-        Bucket._bucket[self.name].add_dict_methods()
+        # Other connections (see core.boto.BucketPool) share the content
+        if self.name not in Bucket._bucket:
+            Bucket._bucket[self.name] = mock_dict.MockDict()
+            Bucket._bucket[self.name].add_dict_methods()
 
     def delete(self):
         if self.name in Bucket._bucket:
             Bucket._bucket[self.name] = mock_dict.MockDict()
             Bucket._bucket[self.name].add_dict_methods()
 
-    def list(self, **kwargs):
-        return ([self.lookup(k) for k in self._bucket_dict.keys()]
-                if self._bucket_dict else [])
+    def list(self, prefix='', delimiter='', **kwargs):
+        if not self._bucket_dict:
+            return []
+        keys = []
+        prefixes = set()
+        for k in sorted(self._bucket_dict.keys()):
+            if not k.startswith(prefix):
+                continue
+            # Keys below a delimiter are rolled up into a common prefix
+            pos = k.find(delimiter, len(prefix)) if delimiter else -1
+            if pos == -1:
+                keys.append(self.lookup(k))
+            else:
+                prefixes.add(k[:pos + len(delimiter)])
+        return keys + [boto.s3.prefix.Prefix(self, p)
+                       for p in sorted(prefixes)]
 
     def lookup(self, key_name, **kwargs):
         if self._bucket_dict and key_name in self._bucket_dict:
@@ -111,7 +127,13 @@ class Key(boto.s3.key.Key):
         self.bucket._bucket_dict[self.name] = value
 
     def get_contents_as_string(self, *args, **kwargs):
-        return self.bucket._bucket_dict[self.name]
+        value = self.bucket._bucket_dict[self.name]
+        headers = kwargs.get('headers') or {}
+        if 'Range' in headers:
+            min_cur, max_cur = (headers['Range'].replace('bytes=', '')
+                                .split('-'))
+            return value[int(min_cur):int(max_cur) + 1]
+        return value
 
     def get_contents_to_file(self, fp, **kwargs):
         min_cur, max_cur = (kwargs['headers']['Range'].replace('bytes=', '')
@@ -14,7 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import time
+import uuid
+
+import mock
+from nose import tools
+
 from docker_registry.core import compat
+from docker_registry.core import exceptions
 from docker_registry.core import lru
 
 # In case you want to mock (and that doesn't work well)
@@ -50,6 +58,33 @@ class Dumb(object):
             return
         del self.value[key]
 
+    @lru.exists
+    def exists(self, key):
+        return key in self.value
+
+    @lru.get_size
+    def get_size(self, key):
+        if key not in self.value:
+            raise exceptions.FileNotFoundError('%s is not there' % key)
+        return len(self.value[key])
+
+
+class Racing(Dumb):
+
+    @lru.exists
+    def exists(self, key):
+        result = key in self.value
+        # Removed while the result is on its way back
+        self.remove(key)
+        return result
+
+
+class Failing(object):
+
+    @lru.set
+    def set(self, key, value):
+        raise IOError('Cannot write {0}'.format(key))
+
 
 class TestLru(object):
 
@@ -112,3 +147,188 @@ class TestLru(object):
         self._dumb.remove('foo')
         assert not self._dumb.get('foo')
         assert not self._dumb.get('foo')
+
+    def testSetUnchanged(self):
+        key = str(uuid.uuid4())
+        self._dumb.set(key, 'bar')
+        del self._dumb.value[key]
+        self._dumb.set(key, 'bar')
+        # Not written again
+        assert key not in self._dumb.value
+        self._dumb.set(key, 'baz')
+        assert self._dumb.value[key] == 'baz'
+
+    def testSetFailure(self):
+        key = str(uuid.uuid4())
+        tools.assert_raises(IOError, Failing().set, key, 'bar')
+        # What could not be written is not cached
+        assert not self._dumb.get(key)
+
+    def testCompressed(self):
+        key = str(uuid.uuid4())
+        content = b'x' * (4 * lru.COMPRESS_THRESHOLD)
+        self._dumb.set(key, content)
+        stored = lru.get_by_key(lru.cache_key(key))
+        assert stored.startswith(lru.COMPRESSED)
+        assert len(stored) < len(content)
+        assert self._dumb.get(key) == content
+
+    def testNotAdmitted(self):
+        key = str(uuid.uuid4())
+        # Not compressible
+        content = os.urandom(lru.MAX_OBJECT_SIZE + 1)
+        rejected = lru.stats['other']['rejected']
+        self._dumb.set(key, content)
+        assert lru.get_by_key(lru.cache_key(key)) is None
+        assert self._dumb.get(key) == content
+        assert lru.get_by_key(lru.cache_key(key)) is None
+        assert lru.stats['other']['rejected'] == rejected + 2
+
+    def testClassTtl(self):
+        image_key = 'images/{0}/json'.format(uuid.uuid4())
+        tag_key = 'repositories/foo/{0}/tag_latest'.format(uuid.uuid4())
+        assert lru.path_class(image_key) == 'image'
+        assert lru.path_class(tag_key) == 'tag'
+        assert lru.path_class(image_key[:-4] + '_files') == 'other'
+        self._dumb.set(image_key, '{}')
+        self._dumb.set(tag_key, '1234')
+        assert lru.redis_conn.ttl(lru.cache_key(image_key)) in (None, -1)
+        assert 0 < lru.redis_conn.ttl(lru.cache_key(tag_key)) <= \
+            lru.TTLS['tag']
+
+    def testExists(self):
+        key = str(uuid.uuid4())
+        assert not self._dumb.exists(key)
+        # Written behind the cache's back
+        self._dumb.value[key] = 'bar'
+        assert not self._dumb.exists(key)
+        self._dumb.set(key, 'bar')
+        assert self._dumb.exists(key)
+        self._dumb.remove(key)
+        assert not self._dumb.exists(key)
+
+    def testExistsRace(self):
+        key = str(uuid.uuid4())
+        self._dumb.value[key] = 'bar'
+        assert Racing().exists(key)
+        assert lru.redis_conn.get(lru.stat_key(key)) is None
+        assert not self._dumb.exists(key)
+
+    def testStatTtl(self):
+        image_key = 'images/{0}/json'.format(uuid.uuid4())
+        key = str(uuid.uuid4())
+        self._dumb.set(image_key, '{}')
+        self._dumb.set(key, 'bar')
+        assert self._dumb.exists(image_key)
+        assert self._dumb.get_size(key) == 3
+        # Existing paths may be removed behind the cache's back as well
+        assert 0 < lru.redis_conn.ttl(lru.stat_key(image_key)) <= \
+            lru.STAT_TTL
+        assert 0 < lru.redis_conn.ttl(lru.stat_key(key)) <= \
+            lru.TTLS['other']
+
+    def testGetSize(self):
+        key = str(uuid.uuid4())
+        self._dumb.set(key, 'bar')
+        assert self._dumb.get_size(key) == 3
+        # Served from the cache
+        self._dumb.value[key] = 'barbaz'
+        assert self._dumb.get_size(key) == 3
+        self._dumb.set(key, 'foobar')
+        assert self._dumb.get_size(key) == 6
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def testGetSizeMissing(self):
+        key = str(uuid.uuid4())
+        tools.assert_raises(exceptions.FileNotFoundError,
+                            self._dumb.get_size, key)
+        self._dumb.value[key] = 'bar'
+        self._dumb.get_size(key)
+
+
+class TestLocal(object):
+
+    def setUp(self):
+        lru.init(local_size=1024)
+        self._dumb = Dumb()
+        for i in range(50):
+            if lru._get_local() is not None:
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        lru.init()
+
+    def testSubscribed(self):
+        key = str(uuid.uuid4())
+        self._dumb.value[key] = 'bar'
+        # Not kept in-process while invalidations may be missed
+        lru._subscribed = False
+        assert self._dumb.get(key) == 'bar'
+        assert lru.local_cache.get(key) is None
+        lru._subscribed = True
+        assert self._dumb.get(key) == 'bar'
+        assert lru.local_cache.get(key) == 'bar'
+
+    def testImmutable(self):
+        image_id = str(uuid.uuid4())
+        json_key = 'images/{0}/json'.format(image_id)
+        mark_key = 'images/{0}/_inprogress'.format(image_id)
+        self._dumb.value[json_key] = '{}'
+        self._dumb.value[mark_key] = 'true'
+        # The json may be pushed again until the mark is removed
+        assert self._dumb.get(json_key) == '{}'
+        expires = lru.local_cache._links[json_key][lru.EXPIRES]
+        assert expires <= time.time() + lru.LOCAL_TTL
+        self._dumb.remove(mark_key)
+        lru.local_cache.pop(json_key)
+        assert self._dumb.get(json_key) == '{}'
+        expires = lru.local_cache._links[json_key][lru.EXPIRES]
+        assert expires > time.time() + lru.LOCAL_TTL
+
+    def testImmutableInvalidated(self):
+        image_id = str(uuid.uuid4())
+        json_key = 'images/{0}/json'.format(image_id)
+        self._dumb.value[json_key] = '{}'
+        exists = Dumb.exists
+
+        def invalidated(dumb, key):
+            # Rewritten while the mark is being checked
+            lru._drop_local(json_key)
+            return exists(dumb, key)
+        with mock.patch.object(Dumb, 'exists', invalidated):
+            assert self._dumb.get(json_key) == '{}'
+        assert lru.local_cache.get(json_key) is None
+
+
+class TestLocalCache(object):
+
+    def setUp(self):
+        self._cache = lru.LocalCache(10, ttl=60, immutable_ttl=3600)
+
+    def testEviction(self):
+        self._cache.set('a', b'1234')
+        self._cache.set('b', b'5678')
+        assert self._cache.get('a') == b'1234'
+        # b is the least recently used
+        self._cache.set('c', b'abcd')
+        assert self._cache.get('b') is None
+        assert self._cache.get('a') == b'1234'
+        assert self._cache.size == 8
+        # Larger than the whole cache
+        self._cache.set('d', b'0123456789a')
+        assert self._cache.get('d') is None
+        assert self._cache.size == 8
+
+    def testExpiration(self):
+        self._cache.max_size = 100
+        self._cache.set('repositories/foo/bar/tag_latest', b'1')
+        self._cache.set('images/1234/ancestry', b'["1234"]', immutable=True)
+        self._cache.ttl = -1
+        self._cache.set('repositories/foo/bar/tag_1.0', b'2')
+        assert self._cache.get('repositories/foo/bar/tag_latest') == b'1'
+        assert self._cache.get('repositories/foo/bar/tag_1.0') is None
+        self._cache.immutable_ttl = -1
+        self._cache.set('images/5678/json', b'{}', immutable=True)
+        assert self._cache.get('images/5678/json') is None
+        assert self._cache.get('images/1234/ancestry') == b'["1234"]'